@@ -1,69 +1,132 @@
 """Use packmole to create a periodic box"""
 
+import concurrent.futures
+import functools
+import hashlib
+import json
 import logging
 import pathlib
 import re
+import shutil
 import subprocess
-import threading
 
 import ase
-import ase.units
 import numpy as np
 import zntrack
-from ase.visualize import view
 
 from ipsuite import base, fields
 from ipsuite.utils.ase_sim import get_box_from_density
 
 log = logging.getLogger(__name__)
 
+_VERSION_NUMBER = r"\d+\.\d+\.\d+"
+_VERSION_RE = re.compile(rf"Version ({_VERSION_NUMBER})")
+_CONDA_VERSION_RE = re.compile(rf"packmol-({_VERSION_NUMBER})-")
 
-def get_packmol_version():
+
+def _get_conda_packmol_version() -> str | None:
+    """Read the packmol version from the conda metadata of its environment."""
+    executable = shutil.which("packmol")
+    if executable is None:
+        return None
+    conda_meta = pathlib.Path(executable).resolve().parent.parent / "conda-meta"
+    for file in conda_meta.glob("packmol-*.json"):
+        version_match = _CONDA_VERSION_RE.match(file.name)
+        if version_match is not None:
+            return version_match.group(1)
+    return None
+
+
+@functools.lru_cache(maxsize=1)
+def _detect_packmol_version() -> str:
+    """Detect the version of the local installed packmol.
+
+    The conda metadata is checked first. Only if packmol was not installed
+    via conda, the packmol binary is started to read its version banner.
+    The result is cached, so this runs once per Python process.
     """
-    Get the version of the local installed packmol.
+    version = _get_conda_packmol_version()
+    if version is not None:
+        return version
+
+    # packmol prints its banner and then waits for the input file on stdin.
+    # With an empty stdin it hits EOF right away and exits on its own, so the
+    # output can be read without a reader thread or a fixed timeout.
+    process = subprocess.Popen(
+        ["packmol"],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+    )
+    try:
+        full_output, _ = process.communicate(timeout=5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        full_output, _ = process.communicate()
+
+    version_match = _VERSION_RE.search(full_output)
+
+    if version_match is None:
+        raise ValueError(f"Could not find version in packmol output: {full_output}")
+
+    return version_match.group(1)
+
+
+def get_packmol_version(
+    user_override: str | None = None,
+) -> tuple[str, tuple[int, ...]]:
     """
+    Get the version of the local installed packmol.
 
-    # packmol when called with --version
-    # will just print a standard output and wait for user input
-    # this function is a bit akward as it needs to read the output
-    # and terminate the subprocess without using a timeout
+    Parameters
+    ----------
+    user_override : str, optional
+        Version to use instead of detecting it. Must have the form
+        "major.minor.patch", e.g. "20.15.0".
 
-    try:
-        process = subprocess.Popen(
-            ["packmol"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+    Returns
+    -------
+    tuple[str, tuple[int, ...]]
+        The version string, e.g. "20.15.0", and its comparable tuple form,
+        e.g. (20, 15, 0).
+    """
+    if user_override is None:
+        version = _detect_packmol_version()
+    elif re.fullmatch(_VERSION_NUMBER, user_override) is None:
+        raise ValueError(
+            f"Invalid packmol version '{user_override}'. Expected the form"
+            " 'major.minor.patch', e.g. '20.15.0'."
         )
+    else:
+        version = user_override
+    return version, tuple(int(part) for part in version.split("."))
 
-        def read_output(process, output_list):
-            try:
-                for line in process.stdout:
-                    output_list.append(line)
-                    if "Version" in line:
-                        break
-            except Exception as e:
-                output_list.append(f"Error: {str(e)}")
 
-        output_lines = []
-        reader_thread = threading.Thread(target=read_output, args=(process, output_lines))
-        reader_thread.start()
+def _atoms_hash(atoms: ase.Atoms) -> str:
+    """Hash the positions and atomic numbers of an ase.Atoms object."""
+    data = atoms.get_positions().tobytes() + atoms.get_atomic_numbers().tobytes()
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
 
-        reader_thread.join(timeout=1)
 
-        if process.poll() is None:
-            process.terminate()
-            process.wait()
+def _read_packmol_xyz(file: pathlib.Path) -> ase.Atoms:
+    """Read the plain xyz file written by packmol.
 
-        reader_thread.join()
-        full_output = "".join(output_lines)
+    Packmol only writes symbols and positions, so the file is parsed with
+    NumPy in one pass instead of going through ase.io.read.
+    """
+    with file.open() as f:
+        n_atoms = int(f.readline())
+        f.readline()
+        data = np.loadtxt(f, dtype=str, usecols=(0, 1, 2, 3), max_rows=n_atoms, ndmin=2)
+    return ase.Atoms(symbols=data[:, 0], positions=data[:, 1:].astype(float))
 
-        version_match = re.search(r"Version (\d+\.\d+\.\d+)", full_output)
 
-        if version_match:
-            return version_match.group(1)
-        else:
-            raise ValueError(f"Could not find version in packmol output: {full_output}")
-
-    except Exception as e:
-        return f"An error occurred: {str(e)}"
+def _run_packmol(structures: pathlib.Path, inp: str, output: str) -> ase.Atoms:
+    """Run packmol on the input file 'inp' and read the packed structure."""
+    with (structures / inp).open("rb") as f:
+        subprocess.check_call(["packmol"], stdin=f, cwd=structures)
+    return _read_packmol_xyz(structures / output)
 
 
 class Packmol(base.IPSNode):
@@ -89,6 +152,22 @@ class Packmol(base.IPSNode):
         If True the periodic boundary conditions are set for the generated structure and
         the box used by packmol is scaled by the tolerance, to avoid overlapping atoms
         with periodic boundary conditions.
+    nloop : int
+        Maximum number of packmol optimization loops. Packmol default if None.
+    maxit : int
+        Maximum number of GENCAN iterations per loop. Packmol default if None.
+    discale : float
+        Scaling factor for the tolerance used in the local optimization.
+        Packmol default if None.
+    movebadrandom : bool
+        If True, badly placed molecules are moved to random positions in the box
+        instead of next to well placed ones.
+    movefrac : float
+        Fraction of molecules that are moved when the optimization stalls.
+        Packmol default if None.
+    packmol_version : str
+        Version of the installed packmol, e.g. "20.15.0". If None the version
+        is read from the conda metadata or by running packmol.
     """
 
     data: list[list[ase.Atoms]] = zntrack.deps()
@@ -100,6 +179,12 @@ class Packmol(base.IPSNode):
     structures = zntrack.outs_path(zntrack.nwd / "packmol")
     atoms = fields.Atoms()
     pbc: bool = zntrack.params(True)
+    nloop: int = zntrack.params(None)
+    maxit: int = zntrack.params(None)
+    discale: float = zntrack.params(None)
+    movebadrandom: bool = zntrack.params(False)
+    movefrac: float = zntrack.params(None)
+    packmol_version: str = zntrack.params(None)
 
     def _post_init_(self):
         if self.box is None and self.density is None:
@@ -112,35 +197,63 @@ class Packmol(base.IPSNode):
             self.box = [self.box, self.box, self.box]
 
     def run(self):
+        import ase.io
+
         self.structures.mkdir(exist_ok=True, parents=True)
         for idx, atoms in enumerate(self.data):
             atoms = atoms[-1] if self.data_ids is None else atoms[self.data_ids[idx]]
-            ase.io.write(self.structures / f"{idx}.xyz", atoms)
+            ase.io.write(self.structures / f"{idx}.xyz", atoms, format="xyz")
 
         if self.density is not None:
             self._get_box_from_molar_volume()
 
-        file = f"""
-        tolerance {self.tolerance}
-        filetype xyz
-        output mixture.xyz
-        """
-
-        packmol_version = get_packmol_version()
-        log.info(f"Packmol version: {packmol_version}")
+        file_head, box_coords = self._get_file_head()
+        parts = [file_head, "output mixture.xyz\n"]
 
-        packmol_version = int(packmol_version.replace(".", ""))
+        for idx, count in enumerate(self.count):
+            parts.append(
+                f"structure {idx}.xyz\n"
+                f"    number {count}\n"
+                f"    inside box 0 0 0 {box_coords}\n"
+                "end structure\n"
+            )
+        file = "".join(parts)
 
-        if self.pbc and packmol_version >= 20150:
-            scaled_box = self.box
+        with pathlib.Path(self.structures / "packmole.inp").open("w") as f:
+            f.write(file)
 
-            request_pbc_str = f"""
-            pbc {" ".join([f"{x:.4f}" for x in scaled_box])}
-            """
+        atoms = _run_packmol(self.structures, "packmole.inp", "mixture.xyz")
+        if self.pbc:
+            atoms.cell = self.box
+            atoms.pbc = True
+        self.atoms = [atoms]
 
-            file += request_pbc_str
+    def _get_file_head(self) -> tuple[str, str]:
+        """Get the packmol input header and the box to place the molecules in.
 
-        elif self.pbc and packmol_version < 20150:
+        Returns
+        -------
+        tuple[str, str]
+            The global packmol keywords and the formatted box corner
+            coordinates, possibly scaled, for the 'inside box' constraint.
+        """
+        parts = [f"tolerance {self.tolerance}\nfiletype xyz\n"]
+
+        if self.nloop is not None:
+            parts.append(f"nloop {self.nloop}\n")
+        if self.maxit is not None:
+            parts.append(f"maxit {self.maxit}\n")
+        if self.discale is not None:
+            parts.append(f"discale {self.discale}\n")
+        if self.movebadrandom:
+            parts.append("movebadrandom\n")
+        if self.movefrac is not None:
+            parts.append(f"movefrac {self.movefrac}\n")
+
+        packmol_version_str, packmol_version = get_packmol_version(self.packmol_version)
+        log.info(f"Packmol version: {packmol_version_str}")
+
+        if self.pbc and packmol_version < (20, 15, 0):
             scaled_box = [x - 2 * self.tolerance for x in self.box]
             log.warning(
                 "Packmol version is too old to use periodic boundary conditions.         "
@@ -150,30 +263,20 @@ class Packmol(base.IPSNode):
         else:
             scaled_box = self.box
 
-        for idx, count in enumerate(self.count):
-            file += f"""
-            structure {idx}.xyz
-                number {count}
-                inside box 0 0 0 {" ".join([f"{x:.4f}" for x in scaled_box])}
-            end structure
-            """
-        with pathlib.Path(self.structures / "packmole.inp").open("w") as f:
-            f.write(file)
+        box_coords = " ".join(f"{x:.4f}" for x in scaled_box)
+        if self.pbc and packmol_version >= (20, 15, 0):
+            parts.append(f"pbc {box_coords}\n")
 
-        subprocess.check_call("packmol < packmole.inp", shell=True, cwd=self.structures)
-
-        atoms = ase.io.read(self.structures / "mixture.xyz")
-        if self.pbc:
-            atoms.cell = self.box
-            atoms.pbc = True
-        self.atoms = [atoms]
+        return "".join(parts), box_coords
 
     def _get_box_from_molar_volume(self):
         """Get the box size from the molar volume"""
         self.box = get_box_from_density(self.data, self.count, self.density)
         log.info(f"estimated box size: {self.box}")
 
-    def view(self) -> view:
+    def view(self):
+        from ase.visualize import view
+
         return view(self.atoms, viewer="x3d")
 
 
@@ -207,79 +310,114 @@ class MultiPackmol(Packmol):
         Number of configurations to create.
     seed : int
         Seed for the random number generator.
+    n_workers : int
+        Number of packmol processes to run concurrently.
     """
 
     n_configurations: int = zntrack.params()
     seed: int = zntrack.params(42)
+    n_workers: int = zntrack.params(1)
     data_ids = None
 
     def run(self):
-        np.random.seed(self.seed)
+        rng = np.random.default_rng(self.seed)
         self.atoms = []
 
         if self.density is not None:
             self._get_box_from_molar_volume()
 
-        file_head = f"""
-        tolerance {self.tolerance}
-        filetype xyz
-        """
-
-        packmol_version = get_packmol_version()
-        log.info(f"Packmol version: {packmol_version}")
-
-        packmol_version = int(packmol_version.replace(".", ""))
-
-        if self.pbc and packmol_version >= 20150:
-            scaled_box = self.box
-
-            request_pbc_str = f"""
-            pbc {" ".join([f"{x:.4f}" for x in scaled_box])}
-            """
-
-            file_head += request_pbc_str
-
-        elif self.pbc and packmol_version < 20150:
-            scaled_box = [x - 2 * self.tolerance for x in self.box]
-            log.warning(
-                "Packmol version is too old to use periodic boundary conditions.         "
-                "       The box size will be scaled by tolerance to avoid overlapping"
-                " atoms."
-            )
-        else:
-            scaled_box = self.box
+        file_head, box_coords = self._get_file_head()
+        # only the structure file name varies between the blocks
+        structure_template = (
+            "structure {name}\n"
+            "    number 1\n"
+            f"    inside box 0 0 0 {box_coords}\n"
+            "end structure\n"
+        )
 
         self.structures.mkdir(exist_ok=True, parents=True)
-        for idx, atoms_list in enumerate(self.data):
-            for jdx, atoms in enumerate(atoms_list):
-                ase.io.write(self.structures / f"{idx}_{jdx}.xyz", atoms)
+        file_names = self._write_structures()
+
+        # draw all conformer indices at once, shape (n_configurations, count)
+        choice_matrix = [
+            rng.integers(0, len(self.data[jdx]), size=(self.n_configurations, count))
+            for jdx, count in enumerate(self.count)
+        ]
 
         for idx in range(self.n_configurations):
-            file = (
-                file_head
-                + f"""
-            output mixture_{idx}.xyz
-            """
-            )
-            for jdx, count in enumerate(self.count):
-                choices = np.random.choice(len(self.data[jdx]), count)
-                for kdx in choices:
-                    file += f"""
-                    structure {jdx}_{kdx}.xyz
-                        number 1
-                        inside box 0 0 0 {" ".join([f"{x:.4f}" for x in scaled_box])}
-                    end structure
-                    """
+            parts = [file_head, f"output mixture_{idx}.xyz\n"]
+            for jdx in range(len(self.count)):
+                choices = choice_matrix[jdx][idx]
+                parts.extend(
+                    structure_template.format(name=file_names[jdx][kdx])
+                    for kdx in choices
+                )
+            file = "".join(parts)
+
             with pathlib.Path(self.structures / f"packmole_{idx}.inp").open("w") as f:
                 f.write(file)
 
-            subprocess.check_call(
-                f"packmol < packmole_{idx}.inp", shell=True, cwd=self.structures
-            )
-
-            atoms = ase.io.read(self.structures / f"mixture_{idx}.xyz")
-            if self.pbc:
-                atoms.cell = self.box
-                atoms.pbc = True
+        # packmol runs in its own process, so threads are enough to keep
+        # 'n_workers' packmol instances busy at the same time.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.n_workers) as ex:
+            futures = [
+                ex.submit(
+                    _run_packmol,
+                    self.structures,
+                    f"packmole_{idx}.inp",
+                    f"mixture_{idx}.xyz",
+                )
+                for idx in range(self.n_configurations)
+            ]
+            for future in futures:
+                atoms = future.result()
+                if self.pbc:
+                    atoms.cell = self.box
+                    atoms.pbc = True
+
+                self.atoms.append(atoms)
+
+    def _write_structures(self) -> list[list[str]]:
+        """Write each unique structure in data to '{hash}.xyz'.
+
+        Structures are identified by a hash of their positions and atomic
+        numbers, so duplicates are only written once. Written hashes are kept
+        in 'manifest.json' and files that already exist are reused. The
+        remaining files are written from a thread pool.
+
+        Returns
+        -------
+        list[list[str]]
+            The xyz file name for each ase.Atoms object in data.
+        """
+        import ase.io
 
-            self.atoms.append(atoms)
+        manifest_file = self.structures / "manifest.json"
+        if manifest_file.exists():
+            manifest = json.loads(manifest_file.read_text())
+        else:
+            manifest = {}
+
+        file_names = []
+        missing = {}
+        for atoms_list in self.data:
+            names = []
+            for atoms in atoms_list:
+                atoms_hash = _atoms_hash(atoms)
+                name = f"{atoms_hash}.xyz"
+                if atoms_hash not in manifest or not (self.structures / name).exists():
+                    missing[name] = atoms
+                    manifest[atoms_hash] = name
+                names.append(name)
+            file_names.append(names)
+
+        def write(item):
+            name, atoms = item
+            ase.io.write(self.structures / name, atoms, format="xyz")
+
+        with concurrent.futures.ThreadPoolExecutor() as ex:
+            # consume the iterator to raise exceptions from the workers
+            list(ex.map(write, missing.items()))
+
+        manifest_file.write_text(json.dumps(manifest, indent=4))
+        return file_names
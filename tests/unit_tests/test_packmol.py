@@ -0,0 +1,153 @@
+import os
+import shutil
+
+import ase.io
+import numpy as np
+import numpy.testing as npt
+import pytest
+from ase.build import molecule
+
+from ipsuite.configuration_generation.packmol import (
+    MultiPackmol,
+    Packmol,
+    _detect_packmol_version,
+    _read_packmol_xyz,
+    get_packmol_version,
+)
+
+# packmol writes the atom count right aligned in a Fortran field
+PACKMOL_XYZ = [
+    "           1\n Built with Packmol\n  O      1.250000     -2.500000      3.125000\n",
+    "           3\n"
+    " Built with Packmol\n"
+    "  O      4.806813      5.157446      4.923585\n"
+    "  H      5.574402      5.611254      4.577306\n"
+    "  H     -4.135817      5.529640      4.605036\n",
+]
+
+
+@pytest.fixture
+def clear_version_cache():
+    _detect_packmol_version.cache_clear()
+    yield
+    _detect_packmol_version.cache_clear()
+
+
+def test_write_structures_deduplicates(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    water = molecule("H2O")
+    node = MultiPackmol(
+        data=[[water, water.copy()]], count=[2], box=[10, 10, 10], n_configurations=1
+    )
+    node.structures.mkdir(parents=True)
+
+    file_names = node._write_structures()
+    assert file_names[0][0] == file_names[0][1]
+    assert [x.name for x in node.structures.glob("*.xyz")] == [file_names[0][0]]
+    assert (node.structures / "manifest.json").exists()
+
+    # a second call must reuse the file listed in the manifest
+    file = node.structures / file_names[0][0]
+    os.utime(file, ns=(0, 0))
+    assert node._write_structures() == file_names
+    assert file.stat().st_mtime_ns == 0
+
+
+def test_get_file_head_solver_keywords(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    water = molecule("H2O")
+    node = Packmol(data=[[water]], count=[1], box=[10, 10, 10], packmol_version="20.15.0")
+    lines = node._get_file_head()[0].splitlines()
+    for keyword in ["nloop", "maxit", "discale", "movebadrandom", "movefrac"]:
+        assert not any(line.startswith(keyword) for line in lines)
+
+    node = Packmol(
+        data=[[water]],
+        count=[1],
+        box=[10, 10, 10],
+        packmol_version="20.15.0",
+        nloop=50,
+        maxit=30,
+        discale=1.5,
+        movebadrandom=True,
+        movefrac=0.1,
+    )
+    lines = node._get_file_head()[0].splitlines()
+    assert "nloop 50" in lines
+    assert "maxit 30" in lines
+    assert "discale 1.5" in lines
+    assert "movebadrandom" in lines
+    assert "movefrac 0.1" in lines
+
+
+@pytest.mark.parametrize(
+    ("version", "pbc", "pbc_line", "box_coords"),
+    [
+        ("20.14.4", True, None, "6.0000 6.0000 6.0000"),
+        ("20.15.0", True, "pbc 10.0000 10.0000 10.0000", "10.0000 10.0000 10.0000"),
+        ("21.0.1", True, "pbc 10.0000 10.0000 10.0000", "10.0000 10.0000 10.0000"),
+        ("20.15.0", False, None, "10.0000 10.0000 10.0000"),
+    ],
+)
+def test_get_file_head_pbc(tmp_path, monkeypatch, version, pbc, pbc_line, box_coords):
+    monkeypatch.chdir(tmp_path)
+    node = Packmol(
+        data=[[molecule("H2O")]],
+        count=[1],
+        box=[10, 10, 10],
+        tolerance=2.0,
+        pbc=pbc,
+        packmol_version=version,
+    )
+    file_head, coords = node._get_file_head()
+    pbc_lines = [x for x in file_head.splitlines() if x.startswith("pbc")]
+
+    assert pbc_lines == ([] if pbc_line is None else [pbc_line])
+    assert coords == box_coords
+
+
+@pytest.mark.parametrize("content", PACKMOL_XYZ)
+def test_read_packmol_xyz(tmp_path, content):
+    file = tmp_path / "mixture.xyz"
+    file.write_text(content)
+
+    atoms = _read_packmol_xyz(file)
+    reference = ase.io.read(file, format="xyz")
+
+    assert atoms.get_chemical_symbols() == reference.get_chemical_symbols()
+    assert atoms.positions.dtype == np.float64
+    npt.assert_array_equal(atoms.positions, reference.positions)
+
+
+def test_get_packmol_version_override(clear_version_cache):
+    assert get_packmol_version("20.15.0") == ("20.15.0", (20, 15, 0))
+    assert get_packmol_version("21.0.1") == ("21.0.1", (21, 0, 1))
+
+
+@pytest.mark.parametrize("version", ["20.15", "v20.15.0", "20.15.0-beta", ""])
+def test_get_packmol_version_invalid_override(version):
+    with pytest.raises(ValueError, match="Invalid packmol version"):
+        get_packmol_version(version)
+
+
+def test_get_packmol_version_conda(tmp_path, monkeypatch, clear_version_cache):
+    (tmp_path / "bin").mkdir()
+    (tmp_path / "conda-meta").mkdir()
+    (tmp_path / "conda-meta" / "packmol-20.15.1-h0.json").touch()
+    executable = tmp_path / "bin" / "packmol"
+    executable.touch()
+    monkeypatch.setattr(shutil, "which", lambda name: executable.as_posix())
+
+    assert get_packmol_version() == ("20.15.1", (20, 15, 1))
+
+
+def test_get_packmol_version_probe(tmp_path, monkeypatch, clear_version_cache):
+    # without conda-meta the version is read from the packmol banner
+    (tmp_path / "bin").mkdir()
+    executable = tmp_path / "bin" / "packmol"
+    executable.write_text("#!/bin/sh\necho ' Version 20.14.4 '\ncat > /dev/null\n")
+    executable.chmod(0o755)
+    monkeypatch.setattr(shutil, "which", lambda name: executable.as_posix())
+    monkeypatch.setenv("PATH", f"{executable.parent}{os.pathsep}{os.environ['PATH']}")
+
+    assert get_packmol_version() == ("20.14.4", (20, 14, 4))